@@ -1,17 +1,19 @@
-import json
+import atexit
+import io
 import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
 import zipfile
-import PyPDF2
-import io
-import logging
-import warnings
+import pypdfium2 as pdfium
 from urllib.parse import unquote
-from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from src.db_manager import PDFArchiveDatabaseManager
 
-# Подавляем предупреждения PyPDF2
-warnings.filterwarnings("ignore", category=UserWarning, module="PyPDF2")
-logging.getLogger("PyPDF2").setLevel(logging.ERROR)
 TIMEOUT = 60
 
 # Список архивов для пропуска (проблемные архивы)
@@ -19,6 +21,15 @@ SKIP_ARCHIVES = [
     'libgen.scimag39611000-39611999.zip'
 ]
 
+# Сколько готовых batch'ей может ждать потока записи в SQLite
+WRITER_QUEUE_SIZE = 2
+
+# PDF до этого размера читаются в память целиком, большие - потоком или через временный файл
+SPOOL_MAX_SIZE = 4 * 1024 * 1024
+
+_SURROGATE_RE = re.compile('[\ud800-\udfff]')
+_WS_RE = re.compile(r'\s+')
+
 def clean_text_encoding(text):
     """
     Очищает текст от проблемных символов Unicode, включая суррогатные пары
@@ -32,28 +43,164 @@ def clean_text_encoding(text):
     if not isinstance(text, str):
         return str(text)
     
-    if not text:
-        return text
+    # В str только суррогаты (U+D800 до U+DFFF) не кодируются в UTF-8: заменяем их
+    # одним проходом скомпилированного регулярного выражения; без совпадений
+    # возвращается исходная строка без копирования
+    return _SURROGATE_RE.sub('?', text)
+
+class ZipMemberReader(io.RawIOBase):
+    """
+    Поток для чтения несжатого (ZIP_STORED) файла прямо из ZIP архива
+    Данные такого файла лежат в архиве одним куском, поэтому seek - это обычный
+    seek по файлу архива, а память не зависит от размера PDF
+    """
+
+    def __init__(self, zip_path, zip_info):
+        self._file = open(zip_path, 'rb')
+        try:
+            # Локальный заголовок: 30 байт + имя файла + extra-поле, затем данные
+            self._file.seek(zip_info.header_offset)
+            header = self._file.read(30)
+            if len(header) != 30 or header[:4] != b'PK\x03\x04':
+                raise zipfile.BadZipFile(f"Bad local file header for {zip_info.filename}")
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+        except Exception:
+            self._file.close()
+            raise
+        self._start = zip_info.header_offset + 30 + name_length + extra_length
+        self._size = zip_info.file_size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        self._position = min(max(position, 0), self._size)
+        return self._position
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self._size - self._position)
+        if length <= 0:
+            return 0
+        self._file.seek(self._start + self._position)
+        read_size = self._file.readinto(memoryview(buffer)[:length])
+        self._position += read_size
+        return read_size
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def open_pdf_member(zip_ref, file_info):
+    """
+    Открывает PDF из архива в виде, пригодном для PDFium
+
+    Небольшие файлы читаются целиком: из bytes PDFium загружает документ сам,
+    без обращений к Python-потоку на каждый блок.
+    Большие несжатые файлы читаются потоком прямо из архива (память O(размер буфера)).
+    Большие сжатые распаковываются один раз последовательно во временный файл:
+    обратный seek по ZipExtFile заново распаковывает поток с начала, а PDFium
+    постоянно прыгает по файлу (xref в конце). Память процесса пула не зависит
+    от размера PDF
+
+    Returns:
+    - bytes или открытый поток (его нужно закрыть после работы с документом)
+    """
+    if file_info.file_size <= SPOOL_MAX_SIZE:
+        return zip_ref.read(file_info)
+
+    if file_info.compress_type == zipfile.ZIP_STORED and not file_info.flag_bits & 0x1:
+        return io.BufferedReader(ZipMemberReader(zip_ref.filename, file_info), buffer_size=65536)
+
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        with zip_ref.open(file_info) as member:
+            shutil.copyfileobj(member, spooled, 65536)
+        spooled.seek(0)
+    except Exception:
+        spooled.close()
+        raise
+    return spooled
+
+
+def extract_pdf_text(zip_ref, pdf_filename, max_pages=10, max_chars=10000):
+    """
+    Extract text from a PDF within an already opened ZIP archive
+    Errors are raised to the caller
+
+    Args:
+    - zip_ref: Open zipfile.ZipFile object
+    - pdf_filename: Name of the PDF file within the archive, or its ZipInfo
+    - max_pages: Maximum number of pages to extract (default 10)
+    - max_chars: Maximum number of characters to extract (default 10000)
+
+    Returns:
+    - Tuple: (extracted_text, file_size, pages_count)
+    """
+    # Get file size
+    if isinstance(pdf_filename, zipfile.ZipInfo):
+        file_info = pdf_filename
+    else:
+        file_info = zip_ref.getinfo(pdf_filename)
+    file_size = file_info.file_size
     
+    pdf_data = open_pdf_member(zip_ref, file_info)
     try:
-        # Сначала пробуем простое кодирование/декодирование с заменой ошибок
-        cleaned = text.encode('utf-8', errors='replace').decode('utf-8')
-        
-        # Дополнительно удаляем суррогатные символы
-        cleaned_chars = []
-        for char in cleaned:
-            char_code = ord(char)
-            # Исключаем суррогатные символы (U+D800 до U+DFFF)
-            if not (0xD800 <= char_code <= 0xDFFF):
-                cleaned_chars.append(char)
-            else:
-                cleaned_chars.append('?')
-        
-        return ''.join(cleaned_chars)
-        
-    except Exception as e:
-        # В крайнем случае возвращаем строку с заменёнными символами
-        return str(text).encode('utf-8', errors='replace').decode('utf-8')
+        # Не PDF (нет заголовка %PDF- в первых 1024 байтах) отбрасываем, не запуская PDFium
+        if isinstance(pdf_data, bytes):
+            header = pdf_data[:1024]
+        else:
+            header = pdf_data.read(1024)
+            pdf_data.seek(0)
+        if b'%PDF-' not in header:
+            raise ValueError("Not a PDF file (no %PDF- header)")
+
+        pdf = pdfium.PdfDocument(pdf_data)
+        try:
+            pages_count = len(pdf)
+
+            text_parts = []
+            text_length = 0
+            for page_index in range(min(max_pages, pages_count)):
+                page = pdf[page_index]
+                textpage = page.get_textpage()
+                # Очищаем текст от проблемных символов; пробелы схлопываются одним проходом regex
+                page_text = _WS_RE.sub(' ', clean_text_encoding(textpage.get_text_range())).strip()
+                textpage.close()
+                page.close()
+
+                if page_text:
+                    text_parts.append(page_text)
+                    text_length += len(page_text) + 1
+                # Остальные страницы все равно будут обрезаны
+                if text_length >= max_chars:
+                    break
+        finally:
+            pdf.close()
+    finally:
+        if not isinstance(pdf_data, bytes):
+            pdf_data.close()
+
+    # Пробел между страницами, чтобы последнее слово страницы не склеивалось с первым словом следующей
+    truncated_text = ' '.join(text_parts)[:max_chars]
+
+    return truncated_text, file_size, pages_count
+
 
 def extract_pdf_text_from_zip(zip_path, pdf_filename, max_pages=10, max_chars=10000):
     """
@@ -71,28 +218,7 @@ def extract_pdf_text_from_zip(zip_path, pdf_filename, max_pages=10, max_chars=10
     """
     try:
         with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            # Get file size
-            file_info = zip_ref.getinfo(pdf_filename)
-            file_size = file_info.file_size
-            
-            # Read PDF data and create BytesIO stream for PyPDF2
-            pdf_data = zip_ref.read(pdf_filename)
-            pdf_stream = io.BytesIO(pdf_data)
-            
-            pdf_reader = PyPDF2.PdfReader(pdf_stream)
-            pages_count = len(pdf_reader.pages)
-
-            full_text = ""
-            for page in pdf_reader.pages[:max_pages]:
-                page_text = page.extract_text()
-                # Очищаем текст от проблемных символов
-                clean_page_text = clean_text_encoding(page_text)
-                full_text += clean_page_text
-
-            cleaned_text = ' '.join(full_text.split())
-            truncated_text = cleaned_text[:max_chars]
-
-            return truncated_text, file_size, pages_count
+            return extract_pdf_text(zip_ref, pdf_filename, max_pages, max_chars)
 
     except Exception as e:
         error_msg = f"Error extracting text from {pdf_filename}: {str(e)}"
@@ -102,19 +228,62 @@ def extract_pdf_text_from_zip(zip_path, pdf_filename, max_pages=10, max_chars=10
         return clean_error_msg, None, None
 
 
+# Архив, открытый в текущем процессе пула: задачи идут по архивам подряд,
+# поэтому центральный каталог ZIP читается один раз на архив, а не на каждый PDF
+_worker_zip_path = None
+_worker_zip_ref = None
+
+
+def extract_pdf_text_in_worker(zip_path, pdf_filename):
+    """
+    Извлекает текст из PDF в процессе пула, переиспользуя открытый ZipFile
+    pdf_filename может быть ZipInfo из infolist() - тогда getinfo() не нужен
+    """
+    global _worker_zip_path, _worker_zip_ref
+
+    if zip_path != _worker_zip_path:
+        if _worker_zip_ref is not None:
+            _worker_zip_ref.close()
+        _worker_zip_path = _worker_zip_ref = None
+        _worker_zip_ref = zipfile.ZipFile(zip_path, 'r')
+        _worker_zip_path = zip_path
+
+    return extract_pdf_text(_worker_zip_ref, pdf_filename)
+
+
+# Файлы журнала ошибок открываются один раз (при первой ошибке) и закрываются при выходе;
+# буферизация построчная: запись об ошибке должна оказаться на диске раньше, чем commit
+# отметит ее архив обработанным, даже если процесс будет убит
+_error_files = {}
+_error_files_lock = threading.Lock()
+
+
+def _close_error_files():
+    for f in _error_files.values():
+        f.close()
+    _error_files.clear()
+
+
+atexit.register(_close_error_files)
+
+
 def write_to_file(error, zip_path, pdf_filename='', output_file='pdf_error.txt'):
-    with open(output_file, 'a', encoding='utf-8', errors='replace') as f:
-        # Очищаем все строки от проблемных символов перед записью
-        clean_zip_path = clean_text_encoding(str(zip_path))
-        clean_pdf_filename = clean_text_encoding(str(pdf_filename))
-        clean_error = clean_text_encoding(str(error))
-        
-        f.write(f"zip_path: {clean_zip_path}\n")
-        f.write(f"pdf_filename: {clean_pdf_filename}\n")
-        f.write(f"error: {clean_error}\n\n")
+    # Очищаем все строки от проблемных символов перед записью
+    clean_zip_path = clean_text_encoding(str(zip_path))
+    clean_pdf_filename = clean_text_encoding(str(pdf_filename))
+    clean_error = clean_text_encoding(str(error))
+
+    # Ошибки пишутся и из основного потока, и из потока записи в БД
+    with _error_files_lock:
+        f = _error_files.get(output_file)
+        if f is None:
+            f = open(output_file, 'a', encoding='utf-8', errors='replace', buffering=1)
+            _error_files[output_file] = f
 
+        f.write(f"zip_path: {clean_zip_path}\npdf_filename: {clean_pdf_filename}\nerror: {clean_error}\n\n")
 
-def process_zip_archives_to_sqlite(db_manager, root_directory, batch_size=10):
+
+def process_zip_archives_to_sqlite(db_manager, root_directory, batch_size=1000, commit_every=5000, max_workers=None):
     """
     Process ZIP archives and write PDF contents to SQLite database in batches
 
@@ -122,108 +291,325 @@ def process_zip_archives_to_sqlite(db_manager, root_directory, batch_size=10):
     - db_manager: PDFArchiveDatabaseManager instance
     - root_directory: Root directory containing ZIP archives
     - batch_size: Number of records to insert in a single batch
+    - commit_every: Number of records written between transaction commits
+    - max_workers: Number of extraction processes (defaults to os.cpu_count())
     """
-    batch = []
-    metadata = json.dumps({"root_directory": root_directory})
-    last_entry = db_manager.get_last_entry()
-    last_processed_pdf = last_entry['pdf_filename'] if last_entry else None
-    entity_count = last_entry['id'] if last_entry else None
+    # Общие для всего запуска метаданные хранятся в БД один раз, в строках - только их id
+    metadata_id = db_manager.get_metadata_id({"root_directory": root_directory})
+    # Архивы, полностью обработанные ранее: неизменившиеся пропускаются без открытия
+    processed_zips = db_manager.get_processed_zips()
+    # Возобновление с архива последней записи - только для БД, заполненных до появления
+    # processed_zips: иначе новые и измененные архивы до него в порядке обхода пропускались бы
+    last_zip_path = None
+    if not processed_zips:
+        last_entry = db_manager.get_last_entry()
+        last_zip_path = last_entry['zip_path'] if last_entry else None
     
     processed_count = 0
-    total_archives = 0
+    uncommitted_count = 0
+    unchanged_archives = 0
+
+    # Сколько задач выдано в пул и сколько результатов получено; архив считается
+    # записанным, когда получены результаты всех его задач
+    task_count = 0
+    result_count = 0
+    listed_archives = deque()     # (номер последней задачи архива, строка processed_zips)
+    completed_archives = []       # строки processed_zips, готовые к записи
+    # Архивы, часть PDF которых не удалось извлечь или записать: они не отмечаются обработанными
+    # и открываются снова при следующем запуске (уже сохраненные PDF пропускаются по именам)
+    failed_zip_paths = set()
     
-    # Подсчитываем общее количество ZIP архивов
+    # Собираем список ZIP архивов один раз: он же используется при обработке
     print("🔍 Сканирование директории...")
-    for root, dirs, files in os.walk(root_directory):
-        total_archives += len([f for f in files if f.lower().endswith('.zip')])
+    zip_paths = list(iter_zip_paths(root_directory))
+    total_archives = len(zip_paths)
+
+    # Если архива, на котором остановились, больше нет в директории - обходим все архивы
+    # (уже сохраненные PDF все равно пропускаются по именам)
+    if last_zip_path and last_zip_path not in {clean_text_encoding(os.path.relpath(p, root_directory)) for p in zip_paths}:
+        print(f"⚠️  Архив последней записи не найден ({last_zip_path}), проверяем все архивы")
+        last_zip_path = None
     
     print(f"📦 Найдено ZIP архивов: {total_archives}")
     print(f"⏰ Установлен таймаут {TIMEOUT} секунд для обработки PDF файлов и получения списка файлов из архивов")
     current_archive = 0
 
-    try:
-        for root, dirs, files in os.walk(root_directory):
-            for file in files:
-                if file.lower().endswith('.zip'):
-                    current_archive += 1
-                    zip_path = os.path.join(root, file)
-                    
-                    # Проверяем, не находится ли архив в списке исключений
-                    if file in SKIP_ARCHIVES:
-                        print(f"⏭️  [{current_archive}/{total_archives}] Пропускаем: {file} (в списке исключений)")
+    def iter_pdf_tasks():
+        """
+        Обходит архивы и выдает (zip_path, pdf_filename, relative_zip_path, unicode_filename, zip_info)
+        для каждого PDF, который еще не был обработан
+        """
+        nonlocal current_archive, last_zip_path, unchanged_archives, task_count
+
+        for zip_path in zip_paths:
+            current_archive += 1
+            file = os.path.basename(zip_path)
+            relative_zip_path = os.path.relpath(zip_path, root_directory)
+            clean_relative_zip_path = clean_text_encoding(relative_zip_path)
+
+            # При возобновлении пропускаем архивы до последнего обработанного, не открывая их
+            if last_zip_path and clean_relative_zip_path != last_zip_path:
+                continue
+
+            try:
+                zip_stat = os.stat(zip_path)
+            except OSError as stat_error:
+                print(f"Error processing ZIP archive {zip_path}: {stat_error}")
+                write_to_file(stat_error, zip_path)
+                continue
+
+            # Архив не изменился с момента, когда все его PDF были записаны
+            if processed_zips.get(clean_relative_zip_path) == (zip_stat.st_mtime, zip_stat.st_size):
+                unchanged_archives += 1
+                last_zip_path = None
+                continue
+            
+            # Проверяем, не находится ли архив в списке исключений
+            if file in SKIP_ARCHIVES:
+                print(f"⏭️  [{current_archive}/{total_archives}] Пропускаем: {file} (в списке исключений)")
+                continue
+                
+            print(f"📁 [{current_archive}/{total_archives}] Обработка: {file}")
+
+            try:
+                # Получаем список файлов с таймаутом
+                all_files = get_zip_infolist_with_timeout(zip_path)
+                if all_files is None:
+                    print(f"   ⏭️  Пропускаем архив {file} (таймаут при получении списка файлов)")
+                    continue
+                
+                # Приводим к нижнему регистру только расширение, а не все имя
+                pdf_infos = (info for info in all_files if info.filename[-4:].lower() == '.pdf')
+                last_zip_path = None
+
+                # PDF этого архива, уже сохраненные в БД, - один запрос на архив
+                existing_filenames = db_manager.get_filenames_for_zip(clean_relative_zip_path)
+
+                pdfs_count = 0
+                for pdf_info in pdf_infos:
+                    pdfs_count += 1
+                    unicode_filename = unquote(pdf_info.filename)
+                    if clean_text_encoding(unicode_filename) in existing_filenames:
                         continue
-                        
-                    print(f"📁 [{current_archive}/{total_archives}] Обработка: {file}")
-
-                    try:
-                        # Получаем список файлов с таймаутом
-                        all_files = get_zip_namelist_with_timeout(zip_path)
-                        if all_files is None:
-                            print(f"   ⏭️  Пропускаем архив {file} (таймаут при получении списка файлов)")
-                            continue
-                        
-                        pdf_files = [f for f in all_files if f.lower().endswith('.pdf')]
-                        
-                        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                            relative_zip_path = os.path.relpath(zip_path, root_directory)
-
-                            # Skip this archive if entity_count > total_pdfs
-                            total_pdfs = len(pdf_files)
-                            if entity_count is not None and entity_count > total_pdfs:
-                                entity_count -= total_pdfs
-                                continue
-
-                            for pdf_filename in pdf_files:
-                                try:
-                                    unicode_filename = unquote(pdf_filename)
-                                    if last_processed_pdf and unicode_filename == last_processed_pdf:
-                                        last_processed_pdf = None  # Сбрасываем, как только достигли последнего обработанного
-                                        continue  # Пропускаем последний обработанный файл
-                                    if last_processed_pdf:  # Пока не достигли последнего файла
-                                        continue
-
-                                    raw_text, file_size, pages_count = extract_pdf_text_with_timeout(zip_path, pdf_filename, timeout=TIMEOUT)
-                                    
-                                    # Пропускаем файл, если произошел таймаут или другая ошибка
-                                    if raw_text is None:
-                                        print(f"   ⏭️  Пропускаем файл {unicode_filename} (таймаут или ошибка)")
-                                        continue
-                                    
-                                    # Дополнительная очистка данных перед сохранением в БД
-                                    clean_raw_text = clean_text_encoding(str(raw_text)) if raw_text else raw_text
-                                    clean_unicode_filename = clean_text_encoding(unicode_filename)
-                                    clean_relative_zip_path = clean_text_encoding(relative_zip_path)
-                                    
-                                    batch.append((clean_relative_zip_path, clean_unicode_filename, clean_raw_text, metadata, file_size, pages_count))
-                                    
-                                    processed_count += 1
-                                    if processed_count % 10 == 0:
-                                        print(f"   ✅ Обработано PDF файлов: {processed_count}")
-
-                                    if len(batch) >= batch_size:
-                                        db_manager.insert_pdf_contents_batch(batch)
-                                        print(f"   💾 Сохранен batch из {len(batch)} записей")
-                                        batch = []  # Reset batch
-
-                                except Exception as pdf_error:
-                                    print(f"Error processing PDF {pdf_filename} in {zip_path}: {pdf_error}")
-                                    write_to_file(pdf_error, zip_path, pdf_filename)
-
-                    except Exception as zip_error:
-                        print(f"Error processing ZIP archive {zip_path}: {zip_error}")
-                        write_to_file(zip_error, zip_path)
-
-        # Insert any remaining records
-        if batch:
-            db_manager.insert_pdf_contents_batch(batch)
-            print(f"💾 Сохранен финальный batch из {len(batch)} записей")
+                    task_count += 1
+                    yield zip_path, pdf_info.filename, relative_zip_path, unicode_filename, pdf_info
+
+                listed_archives.append(
+                    (task_count, (clean_relative_zip_path, zip_stat.st_mtime, zip_stat.st_size, pdfs_count))
+                )
+
+            except Exception as zip_error:
+                print(f"Error processing ZIP archive {zip_path}: {zip_error}")
+                write_to_file(zip_error, zip_path)
+
+    def iter_pdf_rows():
+        """
+        Выдает готовые к записи в БД строки для извлеченных PDF
+        """
+        nonlocal processed_count, result_count
+
+        results = extract_pdf_texts_parallel(iter_pdf_tasks(), max_workers=max_workers, timeout=TIMEOUT)
+        for (zip_path, pdf_filename, relative_zip_path, unicode_filename, _), extracted in results:
+            # Архивы, все задачи которых уже получены, попадут в БД вместе с этой или предыдущими строками
+            result_count += 1
+            while listed_archives and listed_archives[0][0] <= result_count:
+                completed_archives.append(listed_archives.popleft()[1])
+
+            try:
+                raw_text, file_size, pages_count = extracted
+                
+                # Пропускаем файл, если произошел таймаут или другая ошибка
+                if raw_text is None:
+                    print(f"   ⏭️  Пропускаем файл {unicode_filename} (таймаут или ошибка)")
+                    failed_zip_paths.add(clean_text_encoding(relative_zip_path))
+                    continue
+                
+                # Текст уже очищен при извлечении; очищаем имена перед сохранением в БД
+                clean_unicode_filename = clean_text_encoding(unicode_filename)
+                clean_relative_zip_path = clean_text_encoding(relative_zip_path)
+                
+                processed_count += 1
+                if processed_count % 10 == 0:
+                    print(f"   ✅ Обработано PDF файлов: {processed_count}")
+
+                yield clean_relative_zip_path, clean_unicode_filename, raw_text, metadata_id, file_size, pages_count
+
+            except Exception as pdf_error:
+                print(f"Error processing PDF {pdf_filename} in {zip_path}: {pdf_error}")
+                write_to_file(pdf_error, zip_path, pdf_filename)
+                failed_zip_paths.add(clean_text_encoding(relative_zip_path))
+
+        completed_archives.extend(archive for _, archive in listed_archives)
+        listed_archives.clear()
+
+    try:
+        # Сегменты FTS сливаются один раз в конце, а не после каждого commit
+        db_manager.suspend_fts_merging()
+
+        # Одна транзакция на много batch'ей: commit (и fsync) раз в commit_every записей
+        db_manager.begin_transaction()
+
+        def store_batch(batch, archives):
+            nonlocal uncommitted_count
+
+            if batch:
+                if db_manager.insert_pdf_contents_batch(batch):
+                    print(f"   💾 Сохранен batch из {len(batch)} записей")
+                else:
+                    # Не записанные PDF попадают в лог ошибок для retry_failed_pdfs.py
+                    for relative_zip_path, pdf_filename, *_ in batch:
+                        failed_zip_paths.add(relative_zip_path)
+                        write_to_file("Ошибка записи batch в БД", os.path.join(root_directory, relative_zip_path), pdf_filename)
+                    print(f"   ❌ Не удалось сохранить batch из {len(batch)} записей")
+            # В той же транзакции, что и PDF архивов
+            archives = [archive for archive in archives if archive[0] not in failed_zip_paths]
+            if archives:
+                db_manager.mark_zips_processed(archives)
+
+            uncommitted_count += len(batch)
+            if uncommitted_count >= commit_every:
+                db_manager.commit_transaction()
+                db_manager.begin_transaction()
+                uncommitted_count = 0
+
+        # После первой ошибки записи следующие batch'и из очереди уже ничего не пишут
+        write_failed = threading.Event()
+
+        def write_batch(batch, archives):
+            if write_failed.is_set():
+                return
+            try:
+                store_batch(batch, archives)
+            except BaseException:
+                write_failed.set()
+                raise
+
+        # Текст извлекается в пуле процессов, запись в SQLite - в одном отдельном потоке,
+        # чтобы во время записи batch'а этот поток продолжал загружать пул задачами
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            pending_writes = deque()
+            try:
+                for batch in iter_batches(iter_pdf_rows(), batch_size):
+                    archives = completed_archives[:]
+                    completed_archives.clear()
+                    pending_writes.append(writer.submit(write_batch, batch, archives))
+                    # Не больше WRITER_QUEUE_SIZE batch'ей ждут записи; заодно пробрасываем ошибки записи
+                    while len(pending_writes) > WRITER_QUEUE_SIZE:
+                        pending_writes.popleft().result()
+                # Архивы без новых PDF или с ошибками в последних PDF
+                if completed_archives:
+                    pending_writes.append(writer.submit(write_batch, [], completed_archives[:]))
+                while pending_writes:
+                    pending_writes.popleft().result()
+            except BaseException:
+                # Batch'и, еще ждущие в очереди, не записываются: транзакция будет откачена,
+                # а их commit зафиксировал бы только часть данных
+                write_failed.set()
+                for future in pending_writes:
+                    future.cancel()
+                raise
+
+        db_manager.commit_transaction()
+
+        print("🗜️  Слияние сегментов поискового индекса...")
+        db_manager.merge_fts_segments()
         
         print(f"\n🎉 Обработка завершена!")
         print(f"📊 Всего обработано PDF файлов: {processed_count}")
         print(f"📦 Обработано ZIP архивов: {current_archive}")
+        if unchanged_archives:
+            print(f"⏭️  Пропущено неизменившихся архивов: {unchanged_archives}")
 
     except Exception as e:
         print(f"Unexpected error: {e}")
+        # Незафиксированные записи будут обработаны заново при следующем запуске
+        db_manager.rollback_transaction()
+    finally:
+        # automerge хранится в самой БД: без восстановления следующие записи копили бы сегменты.
+        # KeyboardInterrupt не попадает в except, поэтому открытая транзакция откатывается здесь -
+        # иначе восстановление откатилось бы вместе с ней при закрытии соединения
+        try:
+            db_manager.rollback_transaction()
+            db_manager.resume_fts_merging()
+        except Exception as restore_error:
+            print(f"Error restoring search index merging: {restore_error}")
+
+
+def iter_zip_paths(directory):
+    """
+    Рекурсивно выдает пути ZIP архивов в том же порядке, что и os.walk
+    (сначала файлы каталога, затем подкаталоги), от которого зависит возобновление
+
+    Тип записи берется из DirEntry, полученного при чтении каталога, без отдельного stat
+    """
+    subdirectories = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                elif entry.name[-4:].lower() == '.zip':
+                    yield entry.path
+    except OSError:
+        # Как и os.walk, пропускаем недоступные каталоги
+        return
+
+    for subdirectory in subdirectories:
+        yield from iter_zip_paths(subdirectory)
+
+
+def iter_batches(rows, batch_size):
+    """
+    Группирует поток строк в списки по batch_size (последний может быть короче)
+    """
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def extract_pdf_texts_parallel(tasks, max_workers=None, timeout=TIMEOUT):
+    """
+    Извлекает текст из PDF в пуле процессов, сохраняя порядок задач
+
+    Args:
+    - tasks: Итератор кортежей (zip_path, pdf_filename, ..., zip_info)
+    - max_workers: Количество процессов (по умолчанию os.cpu_count())
+    - timeout: Таймаут ожидания результата одного PDF в секундах
+
+    Yields:
+    - (task, (extracted_text, file_size, pages_count)); при таймауте/ошибке - (task, (None, None, None))
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    # Ограничиваем число задач в полете, чтобы не читать все архивы наперед
+    max_pending = max_workers * 4
+    pending = deque()
+
+    def collect(task, future):
+        zip_path, pdf_filename = task[:2]
+        try:
+            return task, future.result(timeout=timeout)
+        except FuturesTimeoutError:
+            error_msg = f"⏰ Таймаут при обработке {pdf_filename} (превышено {timeout} секунд)"
+            print(f"🚨 {error_msg}")
+            write_to_file(f"TIMEOUT: {error_msg}", zip_path, pdf_filename)
+        except Exception as e:
+            error_msg = f"Ошибка при обработке {pdf_filename}: {str(e)}"
+            print(f"🚨 {error_msg}")
+            write_to_file(error_msg, zip_path, pdf_filename)
+        return task, (None, None, None)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for task in tasks:
+            zip_path, zip_info = task[0], task[-1]
+            pending.append((task, executor.submit(extract_pdf_text_in_worker, zip_path, zip_info)))
+            if len(pending) >= max_pending:
+                yield collect(*pending.popleft())
+
+        while pending:
+            yield collect(*pending.popleft())
 
 
 def execute_with_timeout(func, timeout, error_context, zip_path, pdf_filename=None, fallback_result=None):
@@ -258,33 +644,16 @@ def execute_with_timeout(func, timeout, error_context, zip_path, pdf_filename=No
         return fallback_result
 
 
-def extract_pdf_text_with_timeout(zip_path, pdf_filename, max_pages=10, max_chars=10000, timeout=TIMEOUT):
-    """
-    Извлекает текст из PDF с таймаутом
-    """
-    def _extract():
-        return extract_pdf_text_from_zip(zip_path, pdf_filename, max_pages, max_chars)
-    
-    return execute_with_timeout(
-        func=_extract,
-        timeout=timeout,
-        error_context=f"обработке {pdf_filename}",
-        zip_path=zip_path,
-        pdf_filename=pdf_filename,
-        fallback_result=(None, None, None)
-    )
-
-
-def get_zip_namelist_with_timeout(zip_path, timeout=TIMEOUT):
+def get_zip_infolist_with_timeout(zip_path, timeout=TIMEOUT):
     """
-    Получает список файлов из ZIP архива с таймаутом
+    Получает список файлов (ZipInfo) из ZIP архива с таймаутом
     """
-    def _get_namelist():
+    def _get_infolist():
         with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            return zip_ref.namelist()
+            return zip_ref.infolist()
     
     return execute_with_timeout(
-        func=_get_namelist,
+        func=_get_infolist,
         timeout=timeout,
         error_context=f"получении списка файлов из {os.path.basename(zip_path)}",
         zip_path=zip_path,
@@ -309,7 +678,7 @@ def main():
             print("PDF contents have been processed and stored in the database.")
 
         finally:
-            conn.close()
+            db_manager.close()
     else:
         print("Failed to create database connection.")
 
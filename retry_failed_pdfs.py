@@ -6,12 +6,15 @@
 
 import argparse
 import os
-import re
 import json
-from typing import List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
 from src.db_manager import PDFArchiveDatabaseManager
 from filling_db import extract_pdf_text_from_zip, clean_text_encoding
 
+# Сколько повторно обработанных PDF записывается в БД одной транзакцией
+COMMIT_EVERY = 500
+
 
 def parse_error_file(error_file_path: str) -> List[Tuple[str, str, str]]:
     """
@@ -62,13 +65,38 @@ def parse_error_file(error_file_path: str) -> List[Tuple[str, str, str]]:
     return failed_files
 
 
-def retry_failed_pdf(zip_path: str, pdf_filename: str, db_manager: PDFArchiveDatabaseManager, root_directory: str) -> bool:
+def is_within_directory(path: str, directory: str) -> bool:
+    """
+    Проверяет, находится ли путь внутри директории (на любой глубине)
+    """
+    directory = os.path.abspath(directory)
+    try:
+        return os.path.commonpath([directory, os.path.abspath(path)]) == directory
+    except ValueError:
+        # Пути на разных дисках (Windows)
+        return False
+
+
+def extract_for_retry(zip_path: str, pdf_filename: str) -> Optional[Tuple[str, Optional[int], Optional[int]]]:
+    """
+    Извлекает текст одного PDF в процессе пула.
+    
+    Returns:
+        Результат extract_pdf_text_from_zip или None, если ZIP архив не найден
+    """
+    if not os.path.exists(zip_path):
+        return None
+    return extract_pdf_text_from_zip(zip_path, pdf_filename)
+
+
+def retry_failed_pdf(zip_path: str, pdf_filename: str, extracted, db_manager: PDFArchiveDatabaseManager, root_directory: str) -> bool:
     """
-    Пытается повторно обработать один PDF файл.
+    Сохраняет повторно извлеченный текст одного PDF файла.
     
     Args:
         zip_path: Путь к ZIP архиву
         pdf_filename: Имя PDF файла
+        extracted: Результат extract_for_retry
         db_manager: Менеджер базы данных
         root_directory: Корневая директория (для относительного пути)
         
@@ -77,14 +105,14 @@ def retry_failed_pdf(zip_path: str, pdf_filename: str, db_manager: PDFArchiveDat
     """
     try:
         # Проверяем, существует ли файл
-        if not os.path.exists(zip_path):
+        if extracted is None:
             print(f"   ❌ ZIP архив не найден: {zip_path}")
             return False
             
-        # Извлекаем текст из PDF
-        raw_text, file_size, pages_count = extract_pdf_text_from_zip(zip_path, pdf_filename)
+        raw_text, file_size, pages_count = extracted
         
-        if raw_text is None:
+        # При ошибке извлечения вместо текста возвращается сообщение об ошибке, а pages_count - None
+        if raw_text is None or pages_count is None:
             print(f"   ❌ Не удалось извлечь текст из {pdf_filename}")
             return False
             
@@ -99,13 +127,8 @@ def retry_failed_pdf(zip_path: str, pdf_filename: str, db_manager: PDFArchiveDat
         # Создаем метаданные
         metadata = json.dumps({"root_directory": root_directory, "retry": True})
         
-        # Проверяем, не существует ли уже такая запись
-        if db_manager.pdf_exists(clean_relative_zip_path, clean_pdf_filename):
-            print(f"   ⚠️  PDF уже существует в БД: {pdf_filename}")
-            return True
-            
-        # Сохраняем в базу данных
-        db_manager.insert_pdf_content(
+        # Сохраняем в базу данных; уже существующая запись не перезаписывается
+        inserted = db_manager.insert_pdf_content(
             clean_relative_zip_path, 
             clean_pdf_filename, 
             clean_raw_text, 
@@ -113,6 +136,9 @@ def retry_failed_pdf(zip_path: str, pdf_filename: str, db_manager: PDFArchiveDat
             file_size, 
             pages_count
         )
+        if not inserted:
+            print(f"   ⚠️  PDF уже существует в БД: {pdf_filename}")
+            return True
         
         print(f"   ✅ Успешно обработан: {pdf_filename}")
         return True
@@ -150,7 +176,7 @@ def main():
     parser = argparse.ArgumentParser(description='Повторная обработка PDF файлов с ошибками')
     parser.add_argument('error_file', help='Путь к файлу с ошибками (обычно pdf_error.txt)')
     parser.add_argument('--db', default='archive.db', help='Путь к базе данных (по умолчанию: archive.db)')
-    parser.add_argument('--root-dir', help='Корневая директория архивов (если не указана, будет определена автоматически)')
+    parser.add_argument('--root-dir', help='Корневая директория архивов, указанная при индексации (если не указана, берется из базы данных)')
     parser.add_argument('--output', default='retry_errors.txt', help='Файл для записи новых ошибок')
     parser.add_argument('--batch-size', type=int, default=10, help='Размер батча для вывода прогресса')
     
@@ -180,39 +206,56 @@ def main():
             
         print(f"📁 Найдено файлов для повторной обработки: {len(failed_files)}")
         
-        # Определяем корневую директорию, если не указана
+        # Определяем корневую директорию, если не указана: ту, что записана в БД при индексации
+        # и содержит все архивы из файла ошибок. По ней строятся относительные пути, так что
+        # угадывать ее по самим архивам нельзя - иначе PDF сохранился бы второй раз под другим путем
         root_directory = args.root_dir
         if not root_directory:
-            # Пытаемся определить общий корень из путей
-            paths = [zip_path for zip_path, _, _ in failed_files]
-            if paths:
-                root_directory = os.path.commonpath(paths)
-                # Поднимаемся на уровень выше, если нужно
-                while not any(os.path.exists(os.path.join(root_directory, 'libgen.scimag')) for _ in [1]):
-                    parent = os.path.dirname(root_directory)
-                    if parent == root_directory:  # Достигли корня файловой системы
-                        break
-                    root_directory = parent
+            candidates = [
+                root for root in db_manager.get_root_directories()
+                if all(is_within_directory(zip_path, root) for zip_path, _, _ in failed_files)
+            ]
+            if len(candidates) != 1:
+                print("❌ Не удалось определить корневую директорию по базе данных (укажите --root-dir)")
+                return
+            root_directory = candidates[0]
+            
+        if not os.path.isdir(root_directory):
+            print(f"❌ Корневая директория не найдена: {root_directory} (укажите --root-dir)")
+            return
                     
         print(f"📂 Корневая директория: {root_directory}")
         
-        # Обрабатываем файлы
+        # Обрабатываем файлы: текст извлекается в пуле процессов, запись в БД - из этого
+        # процесса, одной транзакцией на COMMIT_EVERY файлов
         successful_count = 0
         failed_retries = []
         
-        for i, (zip_path, pdf_filename, original_error) in enumerate(failed_files, 1):
-            print(f"📄 [{i}/{len(failed_files)}] Обработка: {pdf_filename}")
-            
-            success = retry_failed_pdf(zip_path, pdf_filename, db_manager, root_directory)
-            
-            if success:
-                successful_count += 1
-            else:
-                failed_retries.append((zip_path, pdf_filename, original_error))
+        db_manager.begin_transaction()
+        with ProcessPoolExecutor() as executor:
+            results = executor.map(
+                extract_for_retry,
+                [zip_path for zip_path, _, _ in failed_files],
+                [pdf_filename for _, pdf_filename, _ in failed_files]
+            )
+            for i, ((zip_path, pdf_filename, original_error), extracted) in enumerate(zip(failed_files, results), 1):
+                print(f"📄 [{i}/{len(failed_files)}] Обработка: {pdf_filename}")
                 
-            # Показываем прогресс
-            if i % args.batch_size == 0:
-                print(f"   📊 Прогресс: {i}/{len(failed_files)}, Успешно: {successful_count}, Ошибок: {len(failed_retries)}")
+                success = retry_failed_pdf(zip_path, pdf_filename, extracted, db_manager, root_directory)
+                
+                if success:
+                    successful_count += 1
+                else:
+                    failed_retries.append((zip_path, pdf_filename, original_error))
+                    
+                if i % COMMIT_EVERY == 0:
+                    db_manager.commit_transaction()
+                    db_manager.begin_transaction()
+                    
+                # Показываем прогресс
+                if i % args.batch_size == 0:
+                    print(f"   📊 Прогресс: {i}/{len(failed_files)}, Успешно: {successful_count}, Ошибок: {len(failed_retries)}")
+        db_manager.commit_transaction()
         
         # Финальный отчет
         print(f"\n🎉 Обработка завершена!")
@@ -225,7 +268,7 @@ def main():
             write_retry_errors(failed_retries, args.output)
             
     finally:
-        conn.close()
+        db_manager.close()
 
 
 if __name__ == "__main__":
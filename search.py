@@ -2,8 +2,46 @@
 # -*- coding: utf-8 -*-
 
 import os
-import json
 import sqlite3
+from pathlib import Path
+
+# Размер кэша страниц и memory-mapped I/O для поиска (МБ); переопределяются переменными окружения.
+# mmap и кэш держат одни и те же страницы, поэтому большие значения только раздувают память
+SQLITE_CACHE_MB = int(os.environ.get('PDF_SQLITE_CACHE_MB', 64))
+SQLITE_MMAP_MB = int(os.environ.get('PDF_SQLITE_MMAP_MB', 256))
+
+# Поисковый запрос задается один раз: соединение кэширует подготовленный запрос по его тексту.
+# Сначала FTS5 сам отбирает 20 лучших документов (ORDER BY rank сортируется
+# внутри FTS5), затем 20 поисков по id в pdf_metadata. Фрагменты текста строятся
+# отдельным запросом SNIPPET_SQL только для показываемой страницы
+SEARCH_SQL = '''
+    WITH fts AS (
+        SELECT 
+            rowid,
+            rank AS bm25_score
+        FROM pdf_search_index
+        WHERE pdf_search_index MATCH ?
+        ORDER BY rank
+        LIMIT 20
+    )
+    SELECT 
+        pm.id,
+        pm.zip_path,
+        pm.pdf_filename,
+        -- Нужные поля метаданных извлекаются в SQLite, без json.loads на каждый показ
+        CASE WHEN json_valid(pm.metadata) THEN json_extract(pm.metadata, '$.file_size') END AS file_size,
+        CASE WHEN json_valid(pm.metadata) THEN json_extract(pm.metadata, '$.pages_count') END AS pages_count,
+        fts.bm25_score
+    FROM fts
+    JOIN pdf_metadata pm ON pm.id = fts.rowid
+    ORDER BY fts.bm25_score
+'''
+
+# Фрагменты для документов одной страницы; к запросу добавляется "(?, ?, ...)" по числу id
+SNIPPET_SQL = '''
+    SELECT rowid, snippet(pdf_search_index, 0, '<b>', '</b>', '...', 100)
+    FROM pdf_search_index
+    WHERE pdf_search_index MATCH ? AND rowid IN '''
 
 
 def check_database_integrity(db_path):
@@ -55,20 +93,19 @@ def optimize_database_connection(db_path):
     Создает оптимизированное подключение к большой БД (только для чтения)
     """
     try:
-        # Параметры для работы с большими БД
+        # Подключение только для чтения (mode=ro): без журнала и блокировок записи.
+        # immutable=1 не используется - индексация может идти параллельно с поиском (WAL)
         conn = sqlite3.connect(
-            db_path,
+            Path(db_path).resolve().as_uri() + '?mode=ro',
+            uri=True,
             timeout=60.0,  # Увеличенный таймаут
             check_same_thread=False
         )
         
         # Оптимизация для больших БД (режим чтения)
-        conn.execute("PRAGMA cache_size = -2097152")   # 2 ГБ кэш (2*1024*1024 КБ)
+        conn.execute(f"PRAGMA cache_size = {-SQLITE_CACHE_MB * 1024}")   # Кэш в КБ (отрицательное значение)
         conn.execute("PRAGMA temp_store = MEMORY")      # Временные данные в RAM
-        conn.execute("PRAGMA synchronous = OFF")        # Отключаем синхронизацию для чтения
-        conn.execute("PRAGMA journal_mode = MEMORY")    # Журнал в памяти для чтения
-        conn.execute("PRAGMA mmap_size = 4294967296")   # 4 ГБ memory-mapped I/O
-        conn.execute("PRAGMA read_uncommitted = true")  # Грязное чтение для скорости
+        conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_MB * 1024 * 1024}")  # 0 отключает memory-mapped I/O
         
         return conn
         
@@ -166,11 +203,13 @@ def search_database():
         # Показываем статистику с оптимизацией для больших БД
         print("📊 Загрузка статистики...")
         
-        cursor.execute("SELECT COUNT(*) FROM pdf_metadata")
-        total_docs = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM pdf_search_index")
-        indexed_docs = cursor.fetchone()[0]
+        # Один запрос; документы индекса считаются по теневой таблице docsize (одна строка
+        # на документ) вместо полного прохода по самому FTS5 индексу
+        cursor.execute(
+            "SELECT (SELECT COUNT(*) FROM pdf_metadata), "
+            "(SELECT COUNT(*) FROM pdf_search_index_docsize)"
+        )
+        total_docs, indexed_docs = cursor.fetchone()
         
         print(f"📊 Статистика базы данных:")
         print(f"   Всего документов: {total_docs:,}")
@@ -205,20 +244,7 @@ def search_database():
                 # Оптимизированный поиск для больших БД
                 print("🔍 Выполняется поиск...")
                 
-                cursor.execute('''
-                    SELECT 
-                        pm.id,
-                        pm.zip_path,
-                        pm.pdf_filename,
-                        pm.metadata,
-                        bm25(pdf_search_index) as bm25_score,
-                        snippet(pdf_search_index, 0, '<b>', '</b>', '...', 100) as snippet
-                    FROM pdf_metadata pm
-                    JOIN pdf_search_index ON pm.id = pdf_search_index.rowid
-                    WHERE pdf_search_index MATCH ?
-                    ORDER BY bm25(pdf_search_index)
-                    LIMIT 20
-                ''', (query,))
+                cursor.execute(SEARCH_SQL, (query,))
                 
                 results = cursor.fetchall()
                 
@@ -226,11 +252,17 @@ def search_database():
                     print("❌ Ничего не найдено.")
                     continue
                 
-                # Статистика по релевантности
-                very_high = sum(1 for r in results if r[4] < -10.0)
-                high = sum(1 for r in results if -10.0 <= r[4] < -8.0)
-                medium = sum(1 for r in results if -8.0 <= r[4] < -5.0)
-                low = sum(1 for r in results if r[4] >= -5.0)
+                # Статистика по релевантности - один проход по результатам
+                very_high = high = medium = low = 0
+                for r in results:
+                    if r[5] < -10.0:
+                        very_high += 1
+                    elif r[5] < -8.0:
+                        high += 1
+                    elif r[5] < -5.0:
+                        medium += 1
+                    else:
+                        low += 1
                 
                 print(f"\n✅ Найдено результатов: {len(results)}")
                 print(f"📈 Релевантность: ⭐⭐⭐{very_high} ⭐⭐{high} ⭐{medium} ○{low}")
@@ -240,23 +272,23 @@ def search_database():
                 results_per_page = 5
                 total_pages = (len(results) + results_per_page - 1) // results_per_page
                 current_page = 1
+                # Фрагменты уже показанных документов: повторный показ страницы не строит их заново
+                snippets = {}
                 
                 def show_results_page(page_num):
                     start_idx = (page_num - 1) * results_per_page
                     end_idx = min(start_idx + results_per_page, len(results))
                     
+                    missing_ids = [r[0] for r in results[start_idx:end_idx] if r[0] not in snippets]
+                    if missing_ids:
+                        placeholders = '(' + ', '.join('?' * len(missing_ids)) + ')'
+                        cursor.execute(SNIPPET_SQL + placeholders, (query, *missing_ids))
+                        snippets.update(cursor.fetchall())
+                    
                     for i in range(start_idx, end_idx):
                         result = results[i]
-                        doc_id, zip_path, pdf_filename, metadata, bm25_score, snippet = result
-                        
-                        # Парсим метаданные
-                        try:
-                            metadata_dict = json.loads(metadata) if metadata else {}
-                        except (json.JSONDecodeError, TypeError):
-                            metadata_dict = {}
-                        
-                        file_size = metadata_dict.get('file_size')
-                        pages_count = metadata_dict.get('pages_count')
+                        doc_id, zip_path, pdf_filename, file_size, pages_count, bm25_score = result
+                        snippet = snippets.get(doc_id, '')
                         
                         print(f"\n{i+1}. 📄 {pdf_filename}")
                         print(f"   📁 Архив: {os.path.basename(zip_path)}")
@@ -1,5 +1,19 @@
 import sqlite3
 import json
+import threading
+from itertools import chain
+from pathlib import Path
+
+# Statements reused on every insert, defined once; the connection's statement
+# cache (cached_statements=256) keeps them prepared across batches
+INSERT_METADATA_SQL = (
+    'INSERT OR IGNORE INTO pdf_metadata (zip_path, pdf_filename, metadata, metadata_id) VALUES (?, ?, ?, ?)'
+)
+INSERT_METADATA_ROWS_SQL = 'INSERT OR IGNORE INTO pdf_metadata (zip_path, pdf_filename, metadata, metadata_id) VALUES '
+INSERT_SEARCH_SQL = 'INSERT INTO pdf_search_index(rowid, content) VALUES (?, ?)'
+
+# INSERT ... RETURNING is available since SQLite 3.35
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
 
 
 class PDFArchiveDatabaseManager:
@@ -19,6 +33,16 @@ class PDFArchiveDatabaseManager:
         self.conn = None
         self.cursor = None
 
+        # Read-only connections, one per thread, so lookups never queue behind the writer
+        self._local = threading.local()
+        self._read_connections = []
+        self._read_connections_lock = threading.Lock()
+
+        # Multi-row metadata inserts, keyed by row count; rows per statement are
+        # capped by the connection's bound-variable limit
+        self._insert_metadata_rows_sql = {}
+        self._metadata_rows_per_insert = 999 // 4
+
     def create_database_schema(self):
         """
         Create optimized database schema with metadata table and FTS index only
@@ -27,36 +51,96 @@ class PDFArchiveDatabaseManager:
         - sqlite3.Connection object or None if creation fails
         """
         try:
-            # Establish database connection
-            self.conn = sqlite3.connect(self.db_path)
+            # Establish database connection; transactions are managed explicitly.
+            # Writes may come from a dedicated writer thread, one thread at a time
+            self.conn = sqlite3.connect(
+                self.db_path, isolation_level=None, cached_statements=256, check_same_thread=False
+            )
             self.cursor = self.conn.cursor()
+            if hasattr(self.conn, 'getlimit'):
+                variable_limit = self.conn.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+                self._metadata_rows_per_insert = max(1, variable_limit // 4)
+
+            # 8 KB pages suit FTS5 segments of whole documents. The page size can only be
+            # chosen before the first write (and never in WAL mode), so only new databases get it
+            if self.cursor.execute('PRAGMA page_count').fetchone()[0] == 0:
+                self.cursor.execute('PRAGMA page_size = 8192')
+
+            # WAL: one appended write per commit instead of the rollback journal's
+            # two fsyncs; NORMAL skips the fsync on every commit (safe in WAL mode).
+            # WAL also lets read_connection() readers run alongside the writer
+            self.cursor.execute('PRAGMA journal_mode = WAL')
+            self.cursor.execute('PRAGMA synchronous = NORMAL')
+            # Checkpoint every ~1000 pages and truncate the WAL file back to 64 MB afterwards,
+            # so a long bulk load does not leave a multi-gigabyte -wal file behind
+            self.cursor.execute('PRAGMA wal_autocheckpoint = 1000')
+            self.cursor.execute('PRAGMA journal_size_limit = 67108864')
+            self._apply_connection_pragmas(self.cursor)
+
+            # Metadata shared by many PDFs (e.g. root directory of an indexing run), stored once
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS pdf_metadata_sources (
+                    id INTEGER PRIMARY KEY,
+                    json_blob TEXT NOT NULL UNIQUE
+                )
+            ''')
 
-            # Create main table WITHOUT raw_text field (only metadata)
+            # Create main table WITHOUT raw_text field (only metadata).
+            # No AUTOINCREMENT: the rowid alias is just as unique for live rows and
+            # inserts skip the extra sqlite_sequence update
             self.cursor.execute('''
                 CREATE TABLE IF NOT EXISTS pdf_metadata (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id INTEGER PRIMARY KEY,
                     zip_path TEXT NOT NULL,
                     pdf_filename TEXT NOT NULL,
                     metadata TEXT DEFAULT NULL,
+                    metadata_id INTEGER REFERENCES pdf_metadata_sources(id),
                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
                     UNIQUE(zip_path, pdf_filename)
                 )
             ''')
 
-            # Create FTS table that stores ONLY the searchable text (no duplication)
+            # Databases created before pdf_metadata_sources existed lack the metadata_id column
+            columns = {row[1] for row in self.cursor.execute('PRAGMA table_info(pdf_metadata)').fetchall()}
+            if 'metadata_id' not in columns:
+                self.cursor.execute(
+                    'ALTER TABLE pdf_metadata ADD COLUMN metadata_id INTEGER REFERENCES pdf_metadata_sources(id)'
+                )
+
+            # Create FTS table that stores ONLY the searchable text (no duplication).
+            # It keeps its content: search.py builds result snippets from it.
+            # A single 3-character prefix index covers typical "comput*" queries; other
+            # prefix lengths still work by scanning the term list
             self.cursor.execute('''
                 CREATE VIRTUAL TABLE IF NOT EXISTS pdf_search_index 
                 USING fts5(
                     content,
                     tokenize='porter unicode61 remove_diacritics 1',
-                    prefix='2 3 4'
+                    prefix='3'
                 )
             ''')
 
-            # Create index for fast lookups
+            # Keep the search index in sync when metadata rows are deleted
+            self.cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS pdf_metadata_after_delete
+                AFTER DELETE ON pdf_metadata
+                BEGIN
+                    DELETE FROM pdf_search_index WHERE rowid = old.id;
+                END
+            ''')
+
+            # UNIQUE(zip_path, pdf_filename) already provides the lookup index; databases
+            # created earlier also had an identical explicit index, updated on every insert
+            self.cursor.execute('DROP INDEX IF EXISTS idx_pdf_metadata_path')
+
+            # Fully processed archives, so unchanged ones are skipped on re-runs without being opened
             self.cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_pdf_metadata_path 
-                ON pdf_metadata(zip_path, pdf_filename)
+                CREATE TABLE IF NOT EXISTS processed_zips (
+                    zip_path TEXT PRIMARY KEY,
+                    mtime REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    n_pdfs INTEGER NOT NULL
+                )
             ''')
 
             # Commit changes
@@ -67,100 +151,338 @@ class PDFArchiveDatabaseManager:
             print(f"Error creating database: {e}")
             return None
 
+    @staticmethod
+    def _apply_connection_pragmas(cursor):
+        """
+        Apply per-connection PRAGMAs; SQLite does not persist these in the database file
+        """
+        cursor.execute('PRAGMA cache_size = -262144')    # 256 MB page cache (allocated on demand)
+        cursor.execute('PRAGMA temp_store = MEMORY')
+        cursor.execute('PRAGMA mmap_size = 1073741824')  # 1 GB memory-mapped I/O
+        cursor.execute('PRAGMA busy_timeout = 5000')     # wait for locks (e.g. a checkpoint) instead of failing
+
+    def read_connection(self):
+        """
+        Get the calling thread's read-only connection, opening it on first use
+
+        Returns:
+        - sqlite3.Connection opened with mode=ro
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            uri = Path(self.db_path).resolve().as_uri() + '?mode=ro'
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=256)
+            self._apply_connection_pragmas(conn.cursor())
+            self._local.conn = conn
+            with self._read_connections_lock:
+                self._read_connections.append(conn)
+        return conn
+
+    def close_read_connections(self):
+        """
+        Close all read-only connections opened by read_connection()
+        """
+        with self._read_connections_lock:
+            for conn in self._read_connections:
+                conn.close()
+            self._read_connections.clear()
+        self._local = threading.local()
+
+    def close(self):
+        """
+        Refresh planner statistics and close all connections
+        """
+        self.close_read_connections()
+
+        if self.conn:
+            try:
+                # analysis_limit keeps ANALYZE on large tables to a sample of rows
+                self.cursor.execute('PRAGMA analysis_limit = 400')
+                self.cursor.execute('PRAGMA optimize')
+            except sqlite3.Error as e:
+                print(f"Error optimizing database: {e}")
+            self.conn.close()
+            self.conn = None
+            self.cursor = None
+
+    def begin_transaction(self):
+        """
+        Open an explicit transaction so that many batches share a single commit
+        IMMEDIATE takes the write lock up front, so a concurrent writer fails
+        here rather than midway through a batch
+        """
+        if not self.conn or not self.cursor:
+            raise RuntimeError("Database connection not established. Call create_database_schema() first.")
+
+        if not self.conn.in_transaction:
+            self.cursor.execute('BEGIN IMMEDIATE')
+
+    def commit_transaction(self):
+        """
+        Commit the transaction opened by begin_transaction()
+        """
+        if not self.conn or not self.cursor:
+            raise RuntimeError("Database connection not established. Call create_database_schema() first.")
+
+        self.conn.commit()
+
+    def rollback_transaction(self):
+        """
+        Discard the uncommitted part of the transaction opened by begin_transaction()
+        """
+        if not self.conn or not self.cursor:
+            raise RuntimeError("Database connection not established. Call create_database_schema() first.")
+
+        if self.conn.in_transaction:
+            self.conn.rollback()
+
+    def suspend_fts_merging(self):
+        """
+        Disable FTS5 automatic segment merging for the duration of a bulk load
+        Each commit then only appends a new segment; merging is done once by merge_fts_segments()
+        """
+        if not self.conn or not self.cursor:
+            raise RuntimeError("Database connection not established. Call create_database_schema() first.")
+
+        self.cursor.execute("INSERT INTO pdf_search_index(pdf_search_index, rank) VALUES('automerge', 0)")
+
+    def resume_fts_merging(self):
+        """
+        Restore FTS5 automatic segment merging disabled by suspend_fts_merging()
+        The automerge setting is stored in the database, so it must be restored even if the bulk load fails
+        """
+        if not self.conn or not self.cursor:
+            raise RuntimeError("Database connection not established. Call create_database_schema() first.")
+
+        # 4 is the FTS5 default automerge value
+        self.cursor.execute("INSERT INTO pdf_search_index(pdf_search_index, rank) VALUES('automerge', 4)")
+
+    def merge_fts_segments(self, pages_per_step=500):
+        """
+        Restore FTS5 automatic merging and merge the segments accumulated during a bulk load
+        Merge steps are repeated until FTS5 reports no more work, each in its own transaction
+
+        Args:
+        - pages_per_step: Approximate number of pages written per merge step
+        """
+        if not self.conn or not self.cursor:
+            raise RuntimeError("Database connection not established. Call create_database_schema() first.")
+
+        try:
+            self.resume_fts_merging()
+
+            # A change delta below 2 means the merge command found nothing to merge
+            while True:
+                changes_before = self.conn.total_changes
+                self.cursor.execute(
+                    "INSERT INTO pdf_search_index(pdf_search_index, rank) VALUES('merge', ?)",
+                    (pages_per_step,)
+                )
+                if self.conn.total_changes - changes_before < 2:
+                    break
+
+        except sqlite3.Error as e:
+            print(f"Error merging search index: {e}")
+
+    def get_metadata_id(self, metadata):
+        """
+        Store metadata shared by many PDFs once and return its id
+
+        Args:
+        - metadata: Metadata as JSON string or dict
+
+        Returns:
+        - id of the pdf_metadata_sources row, or None for empty metadata or on error
+        """
+        if not self.conn or not self.cursor:
+            raise RuntimeError("Database connection not established. Call create_database_schema() first.")
+
+        if isinstance(metadata, str):
+            try:
+                metadata = json.loads(metadata)
+            except (json.JSONDecodeError, TypeError):
+                metadata = {}
+        if not metadata:
+            return None
+
+        try:
+            json_blob = json.dumps(metadata, sort_keys=True)
+            self.cursor.execute('INSERT OR IGNORE INTO pdf_metadata_sources (json_blob) VALUES (?)', (json_blob,))
+            self.cursor.execute('SELECT id FROM pdf_metadata_sources WHERE json_blob = ?', (json_blob,))
+            return self.cursor.fetchone()[0]
+        except sqlite3.Error as e:
+            print(f"Error storing shared metadata: {e}")
+            return None
+
     def insert_pdf_contents_batch(self, batch):
         """
         Insert a batch of PDF contents into the database
+        Does not commit: wrap calls in begin_transaction()/commit_transaction()
         
         Args:
-        - batch: List of tuples containing (zip_path, pdf_filename, raw_text, metadata, file_size, pages_count)
+        - batch: List of tuples containing (zip_path, pdf_filename, raw_text, metadata_id, file_size, pages_count)
+          where metadata_id comes from get_metadata_id()
+
+        Returns:
+        - True if the batch was written, False if it failed and was rolled back
         """
         if not self.conn or not self.cursor:
             raise RuntimeError("Database connection not established. Call create_database_schema() first.")
 
         try:
+            # Savepoint lets a failed batch roll back without discarding
+            # earlier batches of the enclosing transaction
+            self.cursor.execute('SAVEPOINT insert_batch')
+
             # Insert metadata (without raw_text)
             metadata_batch = []
             search_batch = []
+            search_rows = []
             
             for item in batch:
                 zip_path, pdf_filename, raw_text = item[:3]
-                base_metadata = item[3] if len(item) > 3 else {}
+                metadata_id = item[3] if len(item) > 3 else None
                 file_size = item[4] if len(item) > 4 else None
                 pages_count = item[5] if len(item) > 5 else None
                 
-                # Parse existing metadata if it's a JSON string
-                if isinstance(base_metadata, str):
-                    try:
-                        base_metadata = json.loads(base_metadata)
-                    except (json.JSONDecodeError, TypeError):
-                        base_metadata = {}
-                elif base_metadata is None:
-                    base_metadata = {}
-                
-                # Add file_size and pages_count to metadata
-                if file_size is not None:
-                    base_metadata['file_size'] = file_size
-                if pages_count is not None:
-                    base_metadata['pages_count'] = pages_count
-                
-                # Convert back to JSON string
-                metadata_json = json.dumps(base_metadata)
+                # Only per-file values are stored per row; shared metadata is referenced by metadata_id
+                metadata_json = self._file_metadata_json(file_size, pages_count)
                 
                 # Prepare metadata insert
-                metadata_batch.append((zip_path, pdf_filename, metadata_json))
+                metadata_batch.append((zip_path, pdf_filename, metadata_json, metadata_id))
                 
                 # Prepare search index insert (we'll need the ID)
                 search_batch.append(raw_text)
             
-            # Insert metadata first
-            self.cursor.executemany(
-                'INSERT OR IGNORE INTO pdf_metadata (zip_path, pdf_filename, metadata) VALUES (?, ?, ?)',
-                metadata_batch
-            )
-            
-            # Get the IDs of inserted records
-            inserted_ids = []
-            for zip_path, pdf_filename, _ in metadata_batch:
-                self.cursor.execute(
-                    'SELECT id FROM pdf_metadata WHERE zip_path = ? AND pdf_filename = ?',
-                    (zip_path, pdf_filename)
-                )
-                result = self.cursor.fetchone()
-                if result:
-                    inserted_ids.append(result[0])
+            if HAS_RETURNING:
+                # Insert metadata first: one multi-row statement per chunk instead of a step per row.
+                # RETURNING yields IDs of newly inserted rows only, so PDFs that are already
+                # stored (or repeated within the batch) get no second search index entry
+                texts = {}
+                for (zip_path, pdf_filename, *_), raw_text in zip(metadata_batch, search_batch):
+                    texts.setdefault((zip_path, pdf_filename), raw_text)
+
+                rows_per_insert = self._metadata_rows_per_insert
+                for start in range(0, len(metadata_batch), rows_per_insert):
+                    rows = metadata_batch[start:start + rows_per_insert]
+                    self.cursor.execute(self._insert_metadata_rows(len(rows)), list(chain.from_iterable(rows)))
+                    for record_id, zip_path, pdf_filename in self.cursor.fetchall():
+                        search_rows.append((record_id, texts[(zip_path, pdf_filename)]))
+            else:
+                # SQLite before 3.35: one insert per row, the new ID comes from lastrowid
+                for row, raw_text in zip(metadata_batch, search_batch):
+                    self.cursor.execute(INSERT_METADATA_SQL, row)
+                    if self.cursor.rowcount == 1:
+                        search_rows.append((self.cursor.lastrowid, raw_text))
             
             # Insert into FTS index with explicit rowid mapping
-            for i, raw_text in enumerate(search_batch):
-                if i < len(inserted_ids):
-                    self.cursor.execute(
-                        'INSERT INTO pdf_search_index(rowid, content) VALUES (?, ?)',
-                        (inserted_ids[i], raw_text)
-                    )
+            self.cursor.executemany(INSERT_SEARCH_SQL, search_rows)
             
-            self.conn.commit()
+            self.cursor.execute('RELEASE SAVEPOINT insert_batch')
+            return True
             
         except sqlite3.Error as e:
             print(f"Error inserting batch: {e}")
-            self.conn.rollback()
+            self.cursor.execute('ROLLBACK TO SAVEPOINT insert_batch')
+            self.cursor.execute('RELEASE SAVEPOINT insert_batch')
+            return False
 
     def get_last_entry(self):
         """
         Retrieve the last processed entry from the database
 
         Returns:
-        - Dictionary with the last entry (id, pdf_filename) or None if table is empty
+        - Dictionary with the last entry (id, zip_path, pdf_filename) or None if table is empty
         """
         try:
-            self.cursor.execute("SELECT id, pdf_filename FROM pdf_metadata ORDER BY id DESC LIMIT 1")
-            row = self.cursor.fetchone()
-            return {'id': row[0], 'pdf_filename': row[1]} if row else None
+            row = self.read_connection().execute(
+                "SELECT id, zip_path, pdf_filename FROM pdf_metadata WHERE id = (SELECT MAX(id) FROM pdf_metadata)"
+            ).fetchone()
+            return {'id': row[0], 'zip_path': row[1], 'pdf_filename': row[2]} if row else None
         except sqlite3.Error as e:
             print(f"Error retrieving last entry: {e}")
             return None
 
+    def get_filenames_for_zip(self, zip_path):
+        """
+        Get the names of all PDF files already stored for a ZIP archive
+        One indexed lookup per archive instead of a probe per PDF
+        Runs on a read-only connection and sees only committed rows
+
+        Args:
+        - zip_path: Path to the ZIP archive
+
+        Returns:
+        - Set of pdf_filename values (empty set on error)
+        """
+        try:
+            rows = self.read_connection().execute(
+                'SELECT pdf_filename FROM pdf_metadata WHERE zip_path = ?', (zip_path,)
+            )
+            return {row[0] for row in rows}
+        except sqlite3.Error as e:
+            print(f"Error retrieving filenames for ZIP: {e}")
+            return set()
+
+    def get_processed_zips(self):
+        """
+        Get the archives recorded by mark_zips_processed()
+        Loaded once per run instead of a lookup per archive
+
+        Returns:
+        - Dictionary mapping zip_path to (mtime, size) (empty dictionary on error)
+        """
+        try:
+            rows = self.read_connection().execute('SELECT zip_path, mtime, size FROM processed_zips')
+            return {zip_path: (mtime, size) for zip_path, mtime, size in rows}
+        except sqlite3.Error as e:
+            print(f"Error retrieving processed ZIP archives: {e}")
+            return {}
+
+    def get_root_directories(self):
+        """
+        Get the root directories recorded by indexing runs
+        zip_path values of pdf_metadata are relative to one of them
+        Rows written before pdf_metadata_sources existed keep root_directory in their own metadata
+
+        Returns:
+        - Set of root directory paths (empty set on error)
+        """
+        try:
+            rows = self.read_connection().execute(
+                "SELECT json_extract(json_blob, '$.root_directory') FROM pdf_metadata_sources "
+                "WHERE json_valid(json_blob) "
+                "UNION "
+                "SELECT json_extract(metadata, '$.root_directory') FROM pdf_metadata "
+                "WHERE metadata_id IS NULL AND json_valid(metadata)"
+            )
+            return {row[0] for row in rows if row[0] is not None}
+        except sqlite3.Error as e:
+            print(f"Error retrieving root directories: {e}")
+            return set()
+
+    def mark_zips_processed(self, archives):
+        """
+        Record archives whose PDFs have all been written
+        Does not commit: call inside the transaction that holds the archives' rows,
+        so an archive is never marked without its PDFs
+
+        Args:
+        - archives: List of tuples containing (zip_path, mtime, size, n_pdfs)
+        """
+        if not self.conn or not self.cursor:
+            raise RuntimeError("Database connection not established. Call create_database_schema() first.")
+
+        self.cursor.executemany(
+            'INSERT OR REPLACE INTO processed_zips (zip_path, mtime, size, n_pdfs) VALUES (?, ?, ?, ?)',
+            archives
+        )
+
     def insert_pdf_content(self, zip_path, pdf_filename, raw_text, metadata, file_size=None, pages_count=None):
         """
         Insert a single PDF content into the database
+        Commits on its own unless called inside begin_transaction()/commit_transaction(),
+        in which case a failed insert rolls back only itself
         
         Args:
         - zip_path: Path to the ZIP archive
@@ -169,59 +491,77 @@ class PDFArchiveDatabaseManager:
         - metadata: Metadata as JSON string or dict
         - file_size: Size of the PDF file (optional)
         - pages_count: Number of pages in PDF (optional)
+
+        Returns:
+        - True if the PDF was inserted, False if it was already in the database
         """
         if not self.conn or not self.cursor:
             raise RuntimeError("Database connection not established. Call create_database_schema() first.")
 
+        own_transaction = not self.conn.in_transaction
+
         try:
-            # Parse metadata if it's a string
-            if isinstance(metadata, str):
-                try:
-                    metadata_dict = json.loads(metadata)
-                except (json.JSONDecodeError, TypeError):
-                    metadata_dict = {}
-            elif metadata is None:
-                metadata_dict = {}
+            if own_transaction:
+                self.begin_transaction()
             else:
-                metadata_dict = metadata
+                self.cursor.execute('SAVEPOINT insert_pdf')
 
-            # Add file size and pages count to metadata
-            if file_size is not None:
-                metadata_dict['file_size'] = file_size
-            if pages_count is not None:
-                metadata_dict['pages_count'] = pages_count
+            # Shared metadata is stored once; the row keeps only per-file values
+            metadata_id = self.get_metadata_id(metadata)
+            metadata_json = self._file_metadata_json(file_size, pages_count)
 
-            # Convert back to JSON string
-            metadata_json = json.dumps(metadata_dict)
+            # Insert metadata; the UNIQUE(zip_path, pdf_filename) constraint makes
+            # an existing PDF a no-op, so no separate existence check is needed
+            self.cursor.execute(INSERT_METADATA_SQL, (zip_path, pdf_filename, metadata_json, metadata_id))
+            inserted = self.cursor.rowcount == 1
 
-            # Insert metadata
-            self.cursor.execute(
-                'INSERT OR IGNORE INTO pdf_metadata (zip_path, pdf_filename, metadata) VALUES (?, ?, ?)',
-                (zip_path, pdf_filename, metadata_json)
-            )
-
-            # Get the ID of the inserted or existing record
-            self.cursor.execute(
-                'SELECT id FROM pdf_metadata WHERE zip_path = ? AND pdf_filename = ?',
-                (zip_path, pdf_filename)
-            )
-            result = self.cursor.fetchone()
-            
-            if result:
-                record_id = result[0]
-                # Insert into FTS index
-                self.cursor.execute(
-                    'INSERT OR REPLACE INTO pdf_search_index(rowid, content) VALUES (?, ?)',
-                    (record_id, raw_text)
-                )
+            if inserted:
+                # Insert into FTS index under the new record's ID
+                self.cursor.execute(INSERT_SEARCH_SQL, (self.cursor.lastrowid, raw_text))
 
-            self.conn.commit()
+            if own_transaction:
+                self.conn.commit()
+            else:
+                self.cursor.execute('RELEASE SAVEPOINT insert_pdf')
+            return inserted
 
         except sqlite3.Error as e:
             print(f"Error inserting PDF content: {e}")
-            self.conn.rollback()
+            if own_transaction:
+                self.conn.rollback()
+            else:
+                self.cursor.execute('ROLLBACK TO SAVEPOINT insert_pdf')
+                self.cursor.execute('RELEASE SAVEPOINT insert_pdf')
             raise
 
+    def _insert_metadata_rows(self, row_count):
+        """
+        Get the INSERT OR IGNORE ... RETURNING statement for row_count metadata rows, built once per size
+        """
+        sql = self._insert_metadata_rows_sql.get(row_count)
+        if sql is None:
+            sql = (
+                INSERT_METADATA_ROWS_SQL + ','.join(['(?, ?, ?, ?)'] * row_count)
+                + ' RETURNING id, zip_path, pdf_filename'
+            )
+            self._insert_metadata_rows_sql[row_count] = sql
+        return sql
+
+    @staticmethod
+    def _file_metadata_json(file_size, pages_count):
+        """
+        Build the per-row metadata JSON (file_size, pages_count) or None if both are unknown
+        Both values are integers, so the compact JSON is formatted directly
+        instead of going through json.dumps for every PDF
+        """
+        if file_size is None:
+            if pages_count is None:
+                return None
+            return f'{{"pages_count":{int(pages_count)}}}'
+        if pages_count is None:
+            return f'{{"file_size":{int(file_size)}}}'
+        return f'{{"file_size":{int(file_size)},"pages_count":{int(pages_count)}}}'
+
     def pdf_exists(self, zip_path, pdf_filename):
         """
         Check if a PDF file already exists in the database